@@ -1,12 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.utils import secure_filename
-from twilio.rest import Client
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from dotenv import load_dotenv
 from flask_migrate import Migrate
-from datetime import datetime
-import requests
+from flask_session import Session
+from flask.logging import default_handler
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from zoneinfo import ZoneInfo
+from rq import Queue, Retry, get_current_job
+from logging.handlers import QueueHandler, QueueListener
+import redis
+import orjson
+import logging
+import queue
+import atexit
 import os
 
 # Configurações Twilio (obtenha em twilio.com)
@@ -14,10 +27,40 @@ load_dotenv()
 
 app = Flask(__name__)
 
+# Logs escritos por uma thread de fundo; as rotas só enfileiram o registro
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(QueueHandler(log_queue))
+app.logger.setLevel(logging.INFO)
+# O job do RQ roda num work-horse que termina com os._exit, sem atexit para
+# esvaziar a fila acima: o log dele vai direto para o handler
+job_logger = logging.getLogger('frutt.jobs')
+job_logger.addHandler(log_handler)
+job_logger.setLevel(logging.INFO)
+job_logger.propagate = False
+
 DATABASE_URL = os.getenv('DATABASE_URL')
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+# Pool de conexões por worker: reaproveita conexões quentes (LIFO) e
+# descarta as derrubadas pelo servidor antes de entregá-las a um request.
+# O total de conexões (DB_MAX_CONNECTIONS, abaixo do max_connections do
+# Postgres) é dividido entre os workers do gunicorn (WEB_CONCURRENCY)
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', 80))
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': max(DB_MAX_CONNECTIONS // WEB_CONCURRENCY, 1),
+    'max_overflow': 0,
+    'pool_pre_ping': True,
+    'pool_recycle': 300,
+    'pool_use_lifo': True
+}
 
 app.secret_key = os.getenv('SECRET_KEY')
 
@@ -25,120 +68,364 @@ TWILIO_ACCOUNT = os.getenv('TWILIO_ACCOUNT')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 ADMIN_WHATSAPP = os.getenv('ADMIN_WHATSAPP')
 TWILIO_WHATSAPP_NUMBER = os.getenv('TWILIO_WHATSAPP_NUMBER')
+CABECALHO_WHATSAPP = "🛍️ *NOVA COMPRA NO SITE* 🛍️"
+FUSO_HORARIO = ZoneInfo('America/Sao_Paulo')
+
+# Cliente único, criado no primeiro envio (no worker do RQ): reaproveita a
+# sessão HTTP (keep-alive) com a API da Twilio
+_twilio_client = None
+
+# Cache Redis (listagem de produtos da home)
+rcache = redis.Redis.from_url(os.getenv('REDIS_URL'))
+CACHE_PRODUTOS_KEY = 'produtos:inicio'  # primeira página da home
+CACHE_PRODUTO_PREFIXO = 'produto:'  # página de detalhe de cada produto
+CACHE_PRODUTOS_TTL = 60  # segundos
+PRODUTOS_POR_PAGINA = 24
+LOGIN_MAX_FALHAS = 5
+LOGIN_BLOQUEIO_TTL = 60  # segundos
+
+# Sessões no Redis (o cookie guarda apenas o id da sessão)
+app.config['SESSION_TYPE'] = 'redis'
+app.config['SESSION_REDIS'] = rcache
+Session(app)
+
+# Fila de notificações (rodar o worker com: rq worker --with-scheduler)
+fila = Queue(connection=rcache)
+PEDIDOS_PENDENTES_KEY = 'pedidos:pendentes'
+PEDIDOS_PROCESSANDO_PREFIXO = 'pedidos:processando:'  # uma lista por job em envio
+PEDIDOS_AGENDADO_KEY = 'pedidos:agendado'
+PEDIDOS_AGENDADO_TTL = 60  # segundos; se o job se perder, o próximo pedido reagenda
+JANELA_LOTE_WHATSAPP = timedelta(seconds=2)
+TENTATIVAS_WHATSAPP = Retry(max=3, interval=[10, 60, 300])
+LIMITE_MENSAGEM_WHATSAPP = 1600  # caracteres por mensagem (limite da Twilio)
 
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# Sessão HTTP compartilhada para checar URLs de imagem (conexões reaproveitadas),
+# criada só quando um produto é editado
+_http_session = None
+
 # Rotas administrativas (para adicionar produtos)
 UPLOAD_FOLDER = 'static/imagens'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+_URL_PREFIXES = ('http://', 'https://')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limite de 16MB
 
 
-def enviar_whatsapp_admin(usuario, itens, total, pedido_id):
+def twilio_client():
+    """Retorna o cliente Twilio do processo, criando-o na primeira chamada"""
+    global _twilio_client
+    if _twilio_client is None:
+        # Import tardio: só o worker do RQ precisa carregar o SDK da Twilio
+        from twilio.rest import Client
+        _twilio_client = Client(TWILIO_ACCOUNT, TWILIO_AUTH_TOKEN)
+    return _twilio_client
+
+def http_session():
+    """Retorna a sessão HTTP do processo, criando-a na primeira chamada"""
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=1, backoff_factor=0.1))
+        _http_session.mount('https://', adapter)
+        _http_session.mount('http://', adapter)
+    return _http_session
+
+def formatar_pedido(pedido):
     """
-    Envia notificação de nova compra para o admin via WhatsApp
+    Monta o bloco de texto de um pedido para a mensagem do admin
     Args:
-        usuario: Objeto Usuario do cliente
-        itens: Lista de itens do carrinho
-        total: Valor total da compra
-        pedido_id: ID do pedido
+        pedido: Dict montado em finalizar_compra (cliente, itens, total, ...)
     """
-    client = Client(TWILIO_ACCOUNT, TWILIO_AUTH_TOKEN)
-    
+    cliente = pedido['cliente']
+
     # Formatar itens
     itens_formatados = "\n".join(
-        f"➡ {item.produto.nome} ({item.quantidade}x): R${item.produto.preco * item.quantidade:.2f}"
-        for item in itens
+        f"➡ {item['nome']} ({item['quantidade']}x): R${item['subtotal']:.2f}"
+        for item in pedido['itens']
     )
     
-    # Criar mensagem com dados do cliente
-    mensagem = f"""
-    🛍️ *NOVA COMPRA NO SITE* 🛍️
+    return f"""
+    👤 *Cliente:* {cliente['nome']}
+    📧 *Email:* {cliente['email']}
+    📞 *Telefone:* {cliente['telefone'] or 'Não informado'}
 
-    👤 *Cliente:* {usuario.nome}
-    📧 *Email:* {usuario.email}
-    📞 *Telefone:* {usuario.telefone or 'Não informado'}
-
-    🆔 *Pedido:* #{pedido_id}
+    🆔 *Pedido:* #{pedido['pedido_id']}
     
     🛒 *Itens:*
     {itens_formatados}
 
-    💰 *Total:* R${total:.2f}
+    💰 *Total:* R${pedido['total']:.2f}
 
-    ⏱️ *Data/Hora:* {datetime.now().strftime('%d/%m/%Y %H:%M')}
+    ⏱️ *Data/Hora:* {pedido['data_hora']}
+    """
+
+def dividir_mensagem(texto):
+    """Quebra um texto maior que o limite do WhatsApp em partes, de preferência entre linhas"""
+    partes, atual = [], ''
+    for linha in texto.splitlines(keepends=True):
+        if atual and len(atual) + len(linha) > LIMITE_MENSAGEM_WHATSAPP:
+            partes.append(atual)
+            atual = ''
+        while len(linha) > LIMITE_MENSAGEM_WHATSAPP:
+            partes.append(linha[:LIMITE_MENSAGEM_WHATSAPP])
+            linha = linha[LIMITE_MENSAGEM_WHATSAPP:]
+        atual += linha
+    if atual:
+        partes.append(atual)
+    return partes
+
+def montar_mensagens(pedidos):
+    """
+    Agrupa os pedidos em mensagens de até LIMITE_MENSAGEM_WHATSAPP caracteres
+    Args:
+        pedidos: Lista de pedidos (dicts), na ordem em que foram feitos
+    Returns:
+        Lista de (partes, quantidade): os textos de uma mensagem (mais de um só
+        se um único pedido passar do limite) e quantos pedidos ela cobre
+    """
+    cabecalho = f"\n    {CABECALHO_WHATSAPP}\n"
+    mensagens = []
+    texto, quantidade = cabecalho, 0
+    for pedido in pedidos:
+        bloco = formatar_pedido(pedido)
+        if quantidade and len(texto) + len(bloco) > LIMITE_MENSAGEM_WHATSAPP:
+            mensagens.append((dividir_mensagem(texto), quantidade))
+            texto, quantidade = cabecalho, 0
+        texto += bloco
+        quantidade += 1
+    if quantidade:
+        mensagens.append((dividir_mensagem(texto), quantidade))
+    return mensagens
+
+def enviar_whatsapp_admin(mensagem):
+    """
+    Envia notificação de novas compras para o admin via WhatsApp
+    Args:
+        mensagem: Texto já montado (até LIMITE_MENSAGEM_WHATSAPP caracteres)
     """
-    
     try:
-        message = client.messages.create(
+        message = twilio_client().messages.create(
             body=mensagem,
             from_=TWILIO_WHATSAPP_NUMBER,
             to=ADMIN_WHATSAPP
         )
-        print(f"✅ Notificação enviada! SID: {message.sid}")
+        job_logger.info(f"✅ Notificação enviada! SID: {message.sid}")
         return True
     except Exception as e:
-        print(f"❌ Erro ao enviar WhatsApp: {str(e)}")
+        job_logger.error(f"❌ Erro ao enviar WhatsApp: {str(e)}")
         return False
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def enviar_whatsapp_pendentes():
+    """
+    Job do RQ: envia de uma vez todos os pedidos acumulados na janela de lote.
+    Um pedido só sai do Redis depois que a mensagem com ele foi aceita pela
+    Twilio; se um envio falhar, o job falha e o RQ tenta de novo com o resto.
+    """
+    job = get_current_job()
+    processando = f"{PEDIDOS_PROCESSANDO_PREFIXO}{job.id if job else 'local'}"
+
+    # Pedidos que chegarem a partir daqui agendam um novo job
+    rcache.delete(PEDIDOS_AGENDADO_KEY)
+    # LMOVE é atômico: cada pedido vai para a lista de um único job
+    while rcache.lmove(PEDIDOS_PENDENTES_KEY, processando, 'LEFT', 'RIGHT'):
+        pass
+
+    pendentes = rcache.lrange(processando, 0, -1)
+    for partes, quantidade in montar_mensagens([orjson.loads(p) for p in pendentes]):
+        for parte in partes:
+            if not enviar_whatsapp_admin(parte):
+                raise RuntimeError("Falha ao enviar WhatsApp; pedidos mantidos para nova tentativa")
+        # Já enviados: saem da lista (sem nenhum restante, a chave é apagada)
+        rcache.ltrim(processando, quantidade, -1)
+    return bool(pendentes)
+
+def agendar_envio_pendentes():
+    """Agenda o job de envio, a menos que já haja um esperando a janela de lote"""
+    # SET NX: um único job por janela, mesmo que um agendamento anterior tenha falhado
+    if not rcache.set(PEDIDOS_AGENDADO_KEY, 1, nx=True, ex=PEDIDOS_AGENDADO_TTL):
+        return
+    try:
+        fila.enqueue_in(JANELA_LOTE_WHATSAPP, enviar_whatsapp_pendentes, retry=TENTATIVAS_WHATSAPP)
+    except Exception as e:
+        # O pedido continua na lista; libera a trava para o próximo checkout agendar
+        rcache.delete(PEDIDOS_AGENDADO_KEY)
+        app.logger.error(f"❌ Erro ao agendar envio do WhatsApp: {str(e)}")
+
+def invalidar_cache_produtos(*produto_ids):
+    """Remove do cache a home (e o detalhe dos produtos alterados) num único DEL"""
+    rcache.delete(CACHE_PRODUTOS_KEY, *(f"{CACHE_PRODUTO_PREFIXO}{produto_id}" for produto_id in produto_ids))
+
+# Parâmetros mínimos recomendados pela OWASP para Argon2id
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+def ler_preco(valor):
+    """Converte o preço do formulário para Decimal com 2 casas (coluna NUMERIC)"""
+    try:
+        preco = Decimal(valor)
+        if not preco.is_finite():
+            raise ValueError("Preço inválido")
+        preco = preco.quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError("Preço inválido")
+    # NUMERIC(10,2) guarda no máximo 8 dígitos antes da vírgula
+    if abs(preco) >= Decimal('1e8'):
+        raise ValueError("Preço inválido")
+    return preco
 
 
 class Usuario(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(100), unique=True, nullable=False)
+    email = db.Column(db.String(100), unique=True, nullable=False, index=True)
     senha_hash = db.Column(db.String(256), nullable=False)
     telefone = db.Column(db.String(20))
     admin = db.Column(db.Boolean, default=False)
     
     # Relacionamento com carrinho (opcional)
-    carrinhos = db.relationship('Carrinho', backref='usuario', lazy=True)
+    carrinhos = db.relationship('Carrinho', back_populates='usuario', lazy='raise')
     
     def set_senha(self, senha):
-    # Use pbkdf2 como método mais compacto (ainda seguro)
-        self.senha_hash = generate_password_hash(
-        senha,
-        method='pbkdf2:sha256',
-        salt_length=8
-    )
+        # Argon2id: uma única chamada em C, mais barata que o pbkdf2 em Python
+        self.senha_hash = password_hasher.hash(senha)
+
     def check_senha(self, senha):
-        return check_password_hash(self.senha_hash, senha)
+        # Hashes antigos (pbkdf2:sha256) continuam válidos
+        if not self.senha_hash.startswith('$argon2'):
+            return check_password_hash(self.senha_hash, senha)
+        try:
+            return password_hasher.verify(self.senha_hash, senha)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def precisa_rehash(self):
+        # pbkdf2 legado ou Argon2 com parâmetros diferentes dos atuais
+        if not self.senha_hash.startswith('$argon2'):
+            return True
+        return password_hasher.check_needs_rehash(self.senha_hash)
 
 # Modelo de Produto (Frutas)
 class Produto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False)
-    preco = db.Column(db.Float, nullable=False)
+    preco = db.Column(db.Numeric(10, 2), nullable=False)
     descricao = db.Column(db.Text)
     imagem = db.Column(db.String(256))
     estoque = db.Column(db.Integer, default=0)
 
+    # Raramente percorrido; 'raise' denuncia qualquer N+1 acidental
+    carrinhos = db.relationship('Carrinho', back_populates='produto', lazy='raise')
+
 # Modelo de Carrinho de Compras
 class Carrinho(db.Model):
+    """
+    Item do carrinho de um usuário.
+    Deletes/updates em massa (ex.: limpar o carrinho no checkout) usam
+    synchronize_session=False: o commit vem logo em seguida e os objetos
+    não são reutilizados, então a sincronização da sessão é trabalho à toa.
+    """
+
+    # (usuario_id, produto_id) atende tanto a busca do item no carrinho
+    # quanto as consultas só por usuario_id (prefixo do índice)
+    __table_args__ = (
+        db.Index('ix_carrinho_usuario_produto', 'usuario_id', 'produto_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    usuario_id = db.Column(db.Integer)
     produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'))
     quantidade = db.Column(db.Integer, default=1)
-    produto = db.relationship('Produto', backref='carrinhos')
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    produto = db.relationship('Produto', back_populates='carrinhos', lazy='selectin')
+    usuario = db.relationship('Usuario', back_populates='carrinhos', lazy='raise')
+
+# Numeração dos pedidos (PED0001, ...), criada junto com as tabelas
+pedido_seq = db.Sequence('pedido_seq', metadata=db.metadata)
+
+def produto_para_dict(produto):
+    """Campos usados pelos templates, em tipos simples para o cache"""
+    return {
+        'id': produto.id,
+        'nome': produto.nome,
+        'preco': float(produto.preco),
+        'descricao': produto.descricao,
+        'imagem': produto.imagem,
+        'estoque': produto.estoque
+    }
+
+def total_carrinho(usuario_id):
+    """Soma preço x quantidade do carrinho direto no banco (um único SUM)"""
+    return (
+        db.session.query(db.func.coalesce(db.func.sum(Produto.preco * Carrinho.quantidade), 0))
+        .select_from(Carrinho)
+        .join(Produto, Produto.id == Carrinho.produto_id)
+        .filter(Carrinho.usuario_id == usuario_id)
+        .scalar()
+    )
+
+def produto_e_item_carrinho(produto_id, usuario_id):
+    """
+    Produto + item do carrinho do usuário (ou None) numa única consulta.
+    A linha do produto fica travada (FOR UPDATE) até o commit, então
+    requests simultâneos não validam o estoque em cima da mesma leitura.
+    """
+    return (
+        db.session.query(Produto, Carrinho)
+        .outerjoin(Carrinho, db.and_(
+            Carrinho.produto_id == Produto.id,
+            Carrinho.usuario_id == usuario_id
+        ))
+        .filter(Produto.id == produto_id)
+        .with_for_update(of=Produto)
+        .first()
+    )
 
 # Rotas do site
 @app.route('/')
 def index():
-    # Aumente o número de itens se necessário
-    destaques = Produto.query.all()
-    return render_template('index.html', destaques=destaques)
+    # Paginação por cursor (último id visto): usa o índice da PK em vez de OFFSET
+    cursor = request.args.get('cursor', type=int)
+    if cursor is not None and cursor <= 0:
+        return redirect(url_for('index'))
+
+    # Só a primeira página vai para o cache: o cursor vem do cliente, e cada
+    # valor diferente viraria uma chave nova no Redis
+    data = rcache.get(CACHE_PRODUTOS_KEY) if not cursor else None
+    if data:
+        pagina = orjson.loads(data)
+    else:
+        consulta = Produto.query.order_by(Produto.id.desc())
+        if cursor:
+            consulta = consulta.filter(Produto.id < cursor)
+        # Um item a mais só para saber se existe próxima página
+        produtos = consulta.limit(PRODUTOS_POR_PAGINA + 1).all()
+        tem_proxima = len(produtos) > PRODUTOS_POR_PAGINA
+        produtos = produtos[:PRODUTOS_POR_PAGINA]
+        pagina = {
+            'destaques': [produto_para_dict(p) for p in produtos],
+            'primeira': not cursor,
+            'proximo_cursor': produtos[-1].id if tem_proxima else None
+        }
+        if not cursor:
+            rcache.setex(CACHE_PRODUTOS_KEY, CACHE_PRODUTOS_TTL, orjson.dumps(pagina))
+    return render_template('index.html', destaques=pagina['destaques'], pagina=pagina)
 
 @app.route('/produto/<int:id>')
 def produto(id):
-    produto = Produto.query.get_or_404(id)
+    cache_key = f"{CACHE_PRODUTO_PREFIXO}{id}"
+
+    data = rcache.get(cache_key)
+    if data:
+        produto = orjson.loads(data)
+    else:
+        produto = produto_para_dict(db.get_or_404(Produto, id))
+        rcache.setex(cache_key, CACHE_PRODUTOS_TTL, orjson.dumps(produto))
     return render_template('produto.html', produto=produto)
 
 @app.route('/adicionar_carrinho/<int:produto_id>', methods=['POST'])
@@ -149,8 +436,16 @@ def adicionar_carrinho(produto_id):
         return redirect(url_for('login'))
 
     try:
-        # Obtém o produto e verifica se existe
-        produto = Produto.query.get_or_404(produto_id)
+        # Obtém o produto e o item do carrinho (se houver) numa única consulta
+        try:
+            row = produto_e_item_carrinho(produto_id, session['usuario_id'])
+        except OperationalError:
+            # Deadlock/timeout esperando o lock: tenta mais uma vez
+            db.session.rollback()
+            row = produto_e_item_carrinho(produto_id, session['usuario_id'])
+        if row is None:
+            abort(404)
+        produto, item_carrinho = row
         
         # Obtém a quantidade do formulário (padrão para 1 se não especificado)
         quantidade = int(request.form.get('quantidade', 1))
@@ -165,11 +460,6 @@ def adicionar_carrinho(produto_id):
             return redirect(url_for('produto', id=produto_id))
 
         # Verifica se o item já está no carrinho
-        item_carrinho = Carrinho.query.filter_by(
-            usuario_id=session['usuario_id'], 
-            produto_id=produto_id
-        ).first()
-
         if item_carrinho:
             # Verifica se a nova quantidade + a atual não excede o estoque
             nova_quantidade = item_carrinho.quantidade + quantidade
@@ -196,7 +486,7 @@ def adicionar_carrinho(produto_id):
 
     except Exception as e:
         db.session.rollback()
-        print(f"Erro ao adicionar ao carrinho: {str(e)}")
+        app.logger.error(f"Erro ao adicionar ao carrinho: {str(e)}")
         flash('Ocorreu um erro ao adicionar o item ao carrinho', 'error')
 
     # Redireciona de volta para a página do produto ou para a origem
@@ -207,13 +497,13 @@ def carrinho():
     if 'usuario_id' not in session:
         return redirect(url_for('login'))
     
-    itens = Carrinho.query.filter_by(usuario_id=session['usuario_id']).all()
-    total = sum(item.produto.preco * item.quantidade for item in itens)
+    itens = Carrinho.query.options(selectinload(Carrinho.produto)).filter_by(usuario_id=session['usuario_id']).all()
+    total = total_carrinho(session['usuario_id'])
     return render_template('carrinho.html', itens=itens, total=total)
 
 @app.route('/remover_item/<int:item_id>')
 def remover_item(item_id):
-    item = Carrinho.query.get_or_404(item_id)
+    item = db.get_or_404(Carrinho, item_id)
     db.session.delete(item)
     db.session.commit()
     return redirect(url_for('carrinho'))
@@ -225,24 +515,67 @@ def finalizar_compra():
         return redirect(url_for('login'))
 
     # Obter dados do usuário
-    usuario = Usuario.query.get(session['usuario_id'])
+    usuario = db.session.get(Usuario, session['usuario_id'])
     
     # Obter itens do carrinho
-    itens = Carrinho.query.filter_by(usuario_id=usuario.id).all()
+    itens = Carrinho.query.options(selectinload(Carrinho.produto)).filter_by(usuario_id=usuario.id).all()
+    # Produtos já carregados com os itens: o total sai daqui, sem outro SELECT
     total = sum(item.produto.preco * item.quantidade for item in itens)
-    pedido_id = f"PED{db.session.query(db.func.max(Carrinho.id)).scalar() + 1:04d}"
+
+    # Baixa de estoque atômica: o UPDATE só altera a linha se ainda houver saldo
+    for item in itens:
+        resultado = db.session.execute(
+            update(Produto)
+            .where(Produto.id == item.produto_id, Produto.estoque >= item.quantidade)
+            .values(estoque=Produto.estoque - item.quantidade)
+        )
+        if resultado.rowcount == 0:
+            nome = item.produto.nome
+            db.session.rollback()
+            flash(f'Estoque insuficiente para {nome}', 'error')
+            return redirect(url_for('carrinho'))
+
+    # Data/hora montada pelos campos, sem o parser de formato do strftime
+    agora = datetime.now(FUSO_HORARIO)
+    data_hora = f"{agora.day:02d}/{agora.month:02d}/{agora.year} {agora.hour:02d}:{agora.minute:02d}"
+
+    # nextval é atômico e não volta atrás num rollback: checkouts simultâneos
+    # nunca recebem o mesmo número, e o contador fica salvo no banco
+    pedido_num = db.session.scalar(pedido_seq.next_value())
+    pedido_id = f"PED{pedido_num:04d}"
     
-    # Enviar notificação
-    enviar_whatsapp_admin(
-        usuario=usuario,
-        itens=itens,
-        total=total,
-        pedido_id=pedido_id
-    )
+    # Dados do pedido em tipos simples, pois o carrinho é apagado abaixo
+    pedido = {
+        'pedido_id': pedido_id,
+        'cliente': {
+            'nome': usuario.nome,
+            'email': usuario.email,
+            'telefone': usuario.telefone
+        },
+        'itens': [
+            {
+                'nome': item.produto.nome,
+                'quantidade': item.quantidade,
+                'subtotal': float(item.produto.preco * item.quantidade)
+            }
+            for item in itens
+        ],
+        'total': float(total),
+        'data_hora': data_hora
+    }
+
+    # O estoque desses produtos muda: a home e o detalhe em cache ficam velhos
+    produtos_alterados = {item.produto_id for item in itens}
 
-    # Limpar carrinho
-    Carrinho.query.filter_by(usuario_id=session['usuario_id']).delete()
+    # Limpar carrinho (na mesma transação da baixa de estoque)
+    Carrinho.query.filter_by(usuario_id=session['usuario_id']).delete(synchronize_session=False)
     db.session.commit()
+    invalidar_cache_produtos(*produtos_alterados)
+
+    # Enviar notificação em segundo plano; os pedidos da mesma janela
+    # entram no lote do job já agendado
+    rcache.rpush(PEDIDOS_PENDENTES_KEY, orjson.dumps(pedido))
+    agendar_envio_pendentes()
 
     flash('Compra finalizada! O admin foi notificado.', 'success')
     return render_template('compra_finalizada.html')
@@ -258,6 +591,12 @@ def login():
                 flash('Preencha todos os campos', 'danger')
                 return redirect(url_for('login'))
 
+            # Bloqueia temporariamente após várias senhas erradas, sem rodar o hash
+            chave_falhas = f"login_fail:{email}"
+            if int(rcache.get(chave_falhas) or 0) >= LOGIN_MAX_FALHAS:
+                flash('Muitas tentativas. Aguarde um minuto e tente novamente', 'danger')
+                return redirect(url_for('login'))
+
             usuario = Usuario.query.filter_by(email=email).first()
             
             if not usuario:
@@ -265,10 +604,20 @@ def login():
                 return redirect(url_for('login'))
                 
             if not usuario.check_senha(senha):
+                with rcache.pipeline() as pipe:
+                    pipe.incr(chave_falhas)
+                    pipe.expire(chave_falhas, LOGIN_BLOQUEIO_TTL)
+                    pipe.execute()
                 flash('Credenciais inválidas', 'danger')
                 return redirect(url_for('login'))
             
             # Login bem-sucedido
+            rcache.delete(chave_falhas)
+
+            # Senhas antigas migram para Argon2id no primeiro login
+            if usuario.precisa_rehash():
+                usuario.set_senha(senha)
+                db.session.commit()
             session['usuario_id'] = usuario.id
             session['usuario_nome'] = usuario.nome
             session['admin'] = usuario.admin
@@ -310,7 +659,6 @@ def cadastro():
             db.session.rollback()
             flash(f'Erro: {str(e)}', 'error')
             return redirect(url_for('cadastro'))
-    print(Usuario.query.all()) 
     
     return render_template('cadastro.html')
 
@@ -329,7 +677,7 @@ def adicionar_produto():
             if not nome:
                 raise ValueError("O nome do produto é obrigatório")
                 
-            preco = float(request.form['preco'])
+            preco = ler_preco(request.form['preco'])
             if preco <= 0:
                 raise ValueError("O preço deve ser maior que zero")
                 
@@ -344,17 +692,9 @@ def adicionar_produto():
             if not imagem_url:
                 raise ValueError("A URL da imagem é obrigatória")
                 
-            if not (imagem_url.startswith('http://') or imagem_url.startswith('https://')):
+            if not imagem_url.startswith(_URL_PREFIXES):
                 raise ValueError("A URL da imagem deve começar com http:// ou https://")
                 
-            # Verificação opcional - se a imagem existe (pode ser lento)
-            # try:
-            #     response = requests.head(imagem_url)
-            #     if response.status_code != 200:
-            #         raise ValueError("A URL da imagem não é acessível")
-            # except requests.RequestException:
-            #     raise ValueError("Não foi possível verificar a URL da imagem")
-            
             # Criação do produto no banco de dados
             novo_produto = Produto(
                 nome=nome,
@@ -366,6 +706,7 @@ def adicionar_produto():
             
             db.session.add(novo_produto)
             db.session.commit()
+            invalidar_cache_produtos()
             
             flash('Produto adicionado com sucesso!', 'success')
             return redirect(url_for('index'))
@@ -381,7 +722,7 @@ def adicionar_produto():
 
 @app.route('/admin/editar_produto/<int:id>', methods=['GET', 'POST'])
 def editar_produto(id):
-    produto = Produto.query.get_or_404(id)
+    produto = db.get_or_404(Produto, id)
     
     if request.method == 'POST':
         try:
@@ -390,7 +731,7 @@ def editar_produto(id):
             if not produto.nome:
                 raise ValueError("O nome do produto é obrigatório")
                 
-            produto.preco = float(request.form['preco'])
+            produto.preco = ler_preco(request.form['preco'])
             if produto.preco <= 0:
                 raise ValueError("O preço deve ser maior que zero")
                 
@@ -403,12 +744,13 @@ def editar_produto(id):
             # Processamento da URL da imagem (novo campo)
             nova_url = request.form.get('imagem_url')
             if nova_url and nova_url != produto.imagem:
-                if not (nova_url.startswith('http://') or nova_url.startswith('https://')):
+                if not nova_url.startswith(_URL_PREFIXES):
                     raise ValueError("A URL da imagem deve começar com http:// ou https://")
                 
                 # Verificação opcional da URL (pode ser comentada se não for necessária)
+                import requests
                 try:
-                    response = requests.head(nova_url, timeout=5)
+                    response = http_session().head(nova_url, timeout=3, allow_redirects=True)
                     if response.status_code != 200:
                         raise ValueError("A URL da imagem não é acessível")
                 except requests.RequestException:
@@ -417,6 +759,7 @@ def editar_produto(id):
                 produto.imagem = nova_url
             
             db.session.commit()
+            invalidar_cache_produtos(produto.id)
             
             flash('Produto atualizado com sucesso!', 'success')
             return redirect(url_for('produto', id=produto.id))
@@ -435,7 +778,7 @@ def excluir_produto(id):
     if 'usuario_id' not in session or session['usuario_id'] != 1:
         return redirect(url_for('index'))
     
-    produto = Produto.query.get_or_404(id)
+    produto = db.get_or_404(Produto, id)
     
     try:
         # Remove a imagem associada se não for a default
@@ -447,20 +790,24 @@ def excluir_produto(id):
         
         db.session.delete(produto)
         db.session.commit()
+        invalidar_cache_produtos(id)
         flash('Produto excluído com sucesso!', 'success')
     except Exception as e:
         flash('Ocorreu um erro ao excluir o produto', 'error')
-        print(f"Erro: {str(e)}")
+        app.logger.error(f"Erro ao excluir produto {id}: {str(e)}")
     
     return redirect(url_for('index'))
 
+# Rotas acessíveis sem login (vitrine, autenticação e arquivos estáticos)
+_PUBLIC_ENDPOINTS = frozenset({'login', 'cadastro', 'static', 'index', 'produto'})
+
 @app.before_request
 def before_request():
-    if 'usuario_id' not in session and request.endpoint not in ['login', 'cadastro', 'static']:
+    # URL sem rota: deixa o Flask responder 404 direto, sem tocar na sessão
+    if request.endpoint is None:
+        return None
+    if request.endpoint not in _PUBLIC_ENDPOINTS and 'usuario_id' not in session:
         return redirect(url_for('login'))
 
 def create_app():
     return app
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
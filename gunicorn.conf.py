@@ -0,0 +1,24 @@
+# Configuração do Gunicorn (iniciar com: gunicorn -c gunicorn.conf.py app:app)
+import multiprocessing
+import os
+
+from psycogreen.gevent import patch_psycopg
+
+bind = '0.0.0.0:5000'
+
+# Workers gevent: cada request espera Postgres/Redis/HTTP sem travar o processo.
+# A concorrência vem dos greenlets, então basta um worker por núcleo
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_connections = 1000
+
+
+def on_starting(server):
+    # Número final de workers (já com -w/--workers da linha de comando), herdado
+    # pelos workers: o app divide o pool de conexões do Postgres por ele
+    os.environ['WEB_CONCURRENCY'] = str(server.cfg.workers)
+
+
+def post_fork(server, worker):
+    # Torna o psycopg2 cooperativo com o gevent
+    patch_psycopg()
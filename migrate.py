@@ -1,3 +1,4 @@
+from flask_migrate import stamp
 from app import db
 from app import create_app
 
@@ -8,5 +9,10 @@ def init_db():
         db.create_all()
         print("✅ Database tables created successfully!")
 
+        # As tabelas já saem no schema atual: marca todas as migrações como
+        # aplicadas, senão o próximo "flask db upgrade" tenta recriar índices
+        stamp()
+        print("✅ Database stamped at the latest migration!")
+
 if __name__ == '__main__':
     init_db()
\ No newline at end of file
@@ -0,0 +1,26 @@
+"""pedido seq
+
+Revision ID: 1b1b09b48d7e
+Revises: 65287d4e361f
+Create Date: 2026-10-15 08:05:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b1b09b48d7e'
+down_revision = '65287d4e361f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('pedido_seq')))
+    # Continua a numeração antiga (MAX(carrinho.id) + 1)
+    op.execute("SELECT setval('pedido_seq', (SELECT COALESCE(MAX(id), 0) + 1 FROM carrinho), false)")
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(sa.Sequence('pedido_seq')))